@@ -3,14 +3,23 @@
 # combat tracker, attacks, saves, death saves, inventory, leveling, NPCs, quests, embeds.
 #
 # Requirements:
-# pip install discord.py python-dotenv aiohttp
+# pip install discord.py python-dotenv aiohttp orjson
+# pip install uvloop  (Linux/macOS; Windows keeps the default loop)
 
 import os
 import re
-import json
+import sys
+import mmap
 import random
+import signal
+import tempfile
+import atexit
+import time
+import bisect
 import asyncio
-from typing import Optional, Tuple, List, Dict
+import functools
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Dict, Set
 import aiohttp
 from dotenv import load_dotenv
 import discord
@@ -25,67 +34,402 @@ if not TOKEN:
     print("ERROR: DISCORD_TOKEN tidak ditemukan di .env")
     exit(1)
 
-DATA_FILE = "dnd_data.json"
+DATA_DIR = "data"            # one shard per guild: data/<guild_id>.json
+DATA_FILE = "dnd_data.json"  # legacy single-file store, migrated into DATA_DIR on first load
+MMAP_MIN_BYTES = 1 << 20  # saves at least this large are parsed straight from an mmap
 API_BASE = "https://www.dnd5eapi.co/api"
+API_CACHE_FILE = "api_cache.json"
+API_CACHE_TTL = 86400  # SRD data is static; refresh once a day
+API_CACHE_MAX = 512    # entries kept in memory (and on disk), least recently used dropped first
+
+# Shared HTTP session pool: nearly all traffic goes to the one API host
+HTTP_CONN_LIMIT = 20
+HTTP_CONN_PER_HOST = 8
+HTTP_DNS_TTL = 300
+HTTP_KEEPALIVE = 60
+HTTP_TIMEOUT = 10
 
 # Create a single aiohttp session reused by the bot
 session: Optional[aiohttp.ClientSession] = None
 
+class DMBot(commands.Bot):
+    async def setup_hook(self):
+        # created once before login; every request goes to one host, so keep sockets alive
+        global session
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_CONN_LIMIT,
+                limit_per_host=HTTP_CONN_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE,
+            ),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        )
+
+    async def close(self):
+        # the session lives as long as the bot: transient gateway disconnects keep it,
+        # only a real close releases it. Detach before awaiting so overlapping close()
+        # calls (shutdown() plus bot.run teardown) never close it twice.
+        global session
+        # stop background tasks first so loop teardown never finds them still pending
+        for t in list(_bg_tasks):
+            t.cancel()
+        if _bg_tasks:
+            await asyncio.gather(*_bg_tasks, return_exceptions=True)
+        sess, session = session, None
+        if sess and not sess.closed:
+            await sess.close()
+        await super().close()
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+bot = DMBot(command_prefix="!", intents=intents, help_command=None)
 
-# In-memory structures; persisted to DATA_FILE
-characters: Dict[str, dict] = {}    # guild_id -> name -> data
-initiatives: Dict[str, list] = {}   # guild_id -> list of (name, roll)
-combats: Dict[str, dict] = {}       # guild_id -> {"turn": int, "order": [entities...]}
+# In-memory structures; persisted per guild under DATA_DIR
+# Keyed by the int guild id; it only becomes a str at the file boundary (shard names)
+characters: Dict[int, dict] = {}    # guild_id -> name -> data
+initiatives: Dict[int, list] = {}   # guild_id -> list of (name, roll)
+combats: Dict[int, dict] = {}       # guild_id -> {"turn": int, "order": [entities...], "by_name": {lname: entity}}
 
 # ---------------------------
 # Utilities: Persistence
 # ---------------------------
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        # slot tables use int keys (level -> count), hence OPT_NON_STR_KEYS
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    _loads = orjson.loads
+except ImportError:
+    # stdlib fallback: slower, but reads and writes the same files
+    import json
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def _loads(buf):
+        return json.loads(bytes(buf))
+
+def _read_json(path: str):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_BYTES:
+            return _loads(f.read())
+        # large file: let the parser read the page cache directly instead of copying into bytes
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as buf:
+            return _loads(buf)
+
+def _shard_path(gid: int) -> str:
+    return os.path.join(DATA_DIR, f"{gid}.json")
+
+def _load_shard(gid: int, obj: dict):
+    if obj.get("characters"):
+        characters[gid] = obj["characters"]
+    if obj.get("initiatives"):
+        initiatives[gid] = obj["initiatives"]
+    if obj.get("combats"):
+        combats[gid] = obj["combats"]
+
 def load_data():
     global characters, initiatives, combats
+    characters = {}
+    initiatives = {}
+    combats = {}
+    sharded: Set[int] = set()
+    if os.path.isdir(DATA_DIR):
+        for fname in os.listdir(DATA_DIR):
+            stem = fname[:-len(".json")]
+            if not fname.endswith(".json") or not stem.isdigit():
+                continue
+            gid = int(stem)
+            try:
+                _load_shard(gid, _read_json(os.path.join(DATA_DIR, fname)))
+                sharded.add(gid)
+            except Exception as e:
+                print(f"Gagal load data guild {gid}:", e)
+    # legacy single file still present: a migration has not finished yet
+    migrated: Optional[Set[int]] = None
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                obj = json.load(f)
-                characters = obj.get("characters", {})
-                initiatives = obj.get("initiatives", {})
-                combats = obj.get("combats", {})
+            obj = _read_json(DATA_FILE)
+            migrated = set()
+            for store, section in ((characters, "characters"), (initiatives, "initiatives"), (combats, "combats")):
+                for k, v in obj.get(section, {}).items():
+                    # JSON object keys are strings; skip anything that was never a real guild id.
+                    # A shard written by an earlier, interrupted migration is kept as is
+                    if k.isdigit() and int(k) not in sharded:
+                        store[int(k)] = v
+                        migrated.add(int(k))
         except Exception as e:
             print("Gagal load data:", e)
-            characters = {}
-            initiatives = {}
-            combats = {}
-    else:
-        characters = {}
-        initiatives = {}
-        combats = {}
+    for gid, chars in characters.items():
+        characters[gid] = {name_key(k): v for k, v in chars.items()}
+        for char in chars.values():
+            char["_skill_set"] = skill_set_of(char)
+            char["_spell_keys"] = spell_keys_of(char)
+    _rebuild_char_index()
+    for c in combats.values():
+        index_combat(c)
+    _normalize_inventories()
+    if migrated is not None:
+        _finish_migration(migrated)
     print("Data loaded.")
 
-def save_data():
-    obj = {"characters": characters, "initiatives": initiatives, "combats": combats}
+def _finish_migration(gids: Set[int]):
+    # write every legacy guild to its shard before any command runs; the old file is
+    # only retired once all of them are on disk, so a crash here just retries next start
+    _dirty_guilds.update(gids)
+    save_data()
+    if _dirty_guilds & gids:
+        print(f"Migrasi {DATA_FILE} belum selesai; file lama dibiarkan.")
+        return
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(obj, f, indent=2, ensure_ascii=False)
+        os.replace(DATA_FILE, DATA_FILE + ".migrated")
     except Exception as e:
-        print("Gagal save data:", e)
+        print("Gagal menandai migrasi:", e)
+
+def _normalize_inventories():
+    # older saves stored plain-string items; everything is {"name": ...} from here on
+    for gid, chars in characters.items():
+        for char in chars.values():
+            inv = char.get("inventory")
+            if inv and any(isinstance(i, str) for i in inv):
+                char["inventory"] = [{"name": i} if isinstance(i, str) else i for i in inv]
+                mark_dirty(gid)
+
+def index_combat(c: dict):
+    # by_name is runtime-only: rebuilt from "order" and never written to disk.
+    # On a shared name the first entity in initiative order wins, as in combat_add
+    c["by_name"] = {}
+    for i, ent in enumerate(c["order"]):
+        ent["_key"] = name_key(ent["name"])
+        ent["_seq"] = i
+        c["by_name"].setdefault(ent["_key"], ent)
+    c["next_seq"] = len(c["order"])
+
+# initiative descending; insertion sequence breaks ties so equal rolls keep join order
+def _initiative_key(ent: dict) -> Tuple[int, int]:
+    return -ent["initiative"], ent["_seq"]
+
+SAVE_DEBOUNCE = 3  # seconds between background flushes of dirty state
+
+# Mutations only record which guild changed; the flusher task rewrites just those
+# shards, at most every SAVE_DEBOUNCE seconds
+_dirty_guilds: Set[int] = set()
+_flush_task: Optional[asyncio.Task] = None
+
+# the loop only keeps weak references to tasks; hold them here until they finish
+_bg_tasks: Set[asyncio.Task] = set()
+
+def _spawn(coro) -> asyncio.Task:
+    t = asyncio.create_task(coro)
+    _bg_tasks.add(t)
+    t.add_done_callback(_bg_tasks.discard)
+    return t
+
+def mark_dirty(gid: Optional[int] = None):
+    # no gid: every guild currently in memory
+    if gid is None:
+        _dirty_guilds.update(characters, initiatives, combats)
+    else:
+        _dirty_guilds.add(gid)
+
+# keys starting with "_" on a character or combat entity are runtime caches and stay out of the save file
+def _public(d: dict) -> dict:
+    return {k: v for k, v in d.items() if not k.startswith("_")}
+
+def _serialize_combat(c: dict) -> dict:
+    # by_name and each entity's _key/_seq are rebuilt by index_combat on load
+    out = {k: v for k, v in c.items() if k != "by_name"}
+    out["order"] = [_public(ent) for ent in c["order"]]
+    return out
+
+def _serialize(gid: int) -> bytes:
+    c = combats.get(gid)
+    obj = {
+        "characters": {k: _public(ch) for k, ch in characters.get(gid, {}).items()},
+        "initiatives": initiatives.get(gid, []),
+        "combats": _serialize_combat(c) if c else None,
+    }
+    return _dumps(obj)
+
+# mkstemp creates 0600 files; saves keep the mode a plain open() would give them.
+# Read once here: os.umask() can only be queried by setting it, which is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_FILE_MODE = 0o666 & ~_UMASK
+
+def _write_atomic(path: str, payload: bytes):
+    # write to a temp file then rename, so a crash mid-write never truncates the shard.
+    # Each write gets its own temp file: overlapping saves of one shard never share it
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        try:
+            os.chmod(tmp, _FILE_MODE)
+            f = os.fdopen(fd, "wb")
+        except BaseException:
+            os.close(fd)
+            raise
+        with f:
+            f.write(payload)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def save_data():
+    for gid in list(_dirty_guilds):
+        try:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            _write_atomic(_shard_path(gid), _serialize(gid))
+            _dirty_guilds.discard(gid)
+        except Exception as e:
+            print(f"Gagal save data guild {gid}:", e)
+
+# shutdown() may flush while the flusher task is mid-pass; run one pass at a time
+_flush_lock = asyncio.Lock()
+
+async def _flush():
+    async with _flush_lock:
+        await _flush_dirty()
+
+async def _flush_dirty():
+    gids = list(_dirty_guilds)
+    _dirty_guilds.clear()
+    for i, gid in enumerate(gids):
+        try:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            # serialize on the loop (dicts may mutate under a worker thread), write off-loop
+            payload = _serialize(gid)
+            await asyncio.to_thread(_write_atomic, _shard_path(gid), payload)
+        except asyncio.CancelledError:
+            # cancelled on close: leave the unwritten shards for the final sync save
+            _dirty_guilds.update(gids[i:])
+            raise
+        except Exception as e:
+            _dirty_guilds.add(gid)
+            print(f"Gagal save data guild {gid}:", e)
+
+def _flush_sync():
+    if _dirty_guilds:
+        save_data()
+    save_api_cache()
+
+async def _flusher():
+    while True:
+        await asyncio.sleep(SAVE_DEBOUNCE)
+        if _dirty_guilds:
+            await _flush()
+
+def _on_sigterm(signum, frame):
+    _flush_sync()
+    raise SystemExit(0)
+
+atexit.register(_flush_sync)
+
+def get_guild_id(ctx) -> Optional[int]:
+    return ctx.guild.id if ctx.guild else None
+
+def require_guild(func):
+    # Goes under @bot.command: resolves the guild id once into ctx.gid, or refuses DMs
+    @functools.wraps(func)
+    async def wrapper(ctx, *args, **kwargs):
+        gid = get_guild_id(ctx)
+        if not gid:
+            return await ctx.send("Perintah hanya di server.")
+        ctx.gid = gid
+        return await func(ctx, *args, **kwargs)
+    return wrapper
+
+# Lookup key for characters and combatants. Stored keys are interned too, so a
+# dict probe with an interned key matches on identity before comparing text.
+def name_key(name: str) -> str:
+    return sys.intern(name.lower())
+
+# (gid, name_key) -> character: a flat mirror of `characters` so a lookup is one
+# hash probe. Kept in sync by _put_char/_del_char and rebuilt on load.
+_char_index: Dict[Tuple[int, str], dict] = {}
+
+def _rebuild_char_index():
+    _char_index.clear()
+    for gid, chars in characters.items():
+        for key, char in chars.items():
+            _char_index[(gid, key)] = char
+
+_EMPTY_FS: frozenset = frozenset()
+
+# skill/spell lookups go through lowered keys built once per character;
+# "skills"/"spells" stay the saved lists with their original casing
+def skill_set_of(char: dict) -> frozenset:
+    return frozenset(name_key(s) for s in char.get("skills") or ())
+
+def spell_keys_of(char: dict) -> Dict[str, str]:
+    return {name_key(s): s for s in char.get("spells") or ()}
+
+def _get_char(gid: Optional[int], key: str) -> Optional[dict]:
+    # key comes from name_key()
+    return _char_index.get((gid, key))
+
+def _put_char(gid: int, key: str, char: dict):
+    characters.setdefault(gid, {})[key] = char
+    _char_index[(gid, key)] = char
+
+def _del_char(gid: int, key: str):
+    del characters[gid][key]
+    _char_index.pop((gid, key), None)
 
 # Load on startup
 load_data()
 
-def get_guild_id(ctx) -> Optional[str]:
-    if ctx.guild:
-        return str(ctx.guild.id)
-    return None
-
 # ---------------------------
 # Utilities: Dice parsing / rolling
 # ---------------------------
+_DICE_RE = re.compile(r'(\d*)d(\d+)([+-]\d+)?')
+_MOD_RE = re.compile(r'([+-]?\d+)$')
+
+# Bound generator methods skip the module-level random.* indirection on every die
+_rng = random.Random()
+_randrange = _rng.randrange
+_getrandbits = _rng.getrandbits
+_choices = _rng.choices
+
+def _make_below(n: int):
+    # uniform int in [0, n) from the fewest random bits, redrawing out-of-range values;
+    # built once per fixed pool size, skipping randrange's argument checks on every call
+    bits = (n - 1).bit_length()
+    def below(_g=_getrandbits, _n=n, _b=bits) -> int:
+        i = _g(_b)
+        while i >= _n:
+            i = _g(_b)
+        return i
+    return below
+
+def _make_choice(seq):
+    below = _make_below(len(seq))
+    def pick(_s=seq, _below=below):
+        return _s[_below()]
+    return pick
+
+# the one d20 sampler: _below20() + 1, for single rolls and small d20 batches alike
+_below20 = _make_below(20)
+
+# below this many dice the per-die loop is cheaper than setting up a batch draw
+_BATCH_ROLL_MIN = 4
+
+def _roll_dice(n: int, sides: int) -> List[int]:
+    if n >= _BATCH_ROLL_MIN:
+        # one choices() call draws every die from a single float per roll, with no
+        # per-die randrange bookkeeping (8d6 fireball, 10d6 meteor swarm, ...)
+        return _choices(range(1, sides + 1), k=n)
+    if sides == 20:
+        return [_below20() + 1 for _ in range(n)]
+    return [_randrange(sides) + 1 for _ in range(n)]
+
 def parse_simple_dice(expr: str) -> Optional[dict]:
     # Accepts forms like: 1d20+5, d20, 2d6-1
     expr = expr.replace(" ", "").lower()
-    m = re.fullmatch(r'(\d*)d(\d+)([+-]\d+)?', expr)
+    m = _DICE_RE.fullmatch(expr)
     if not m:
         return None
     n = int(m.group(1)) if m.group(1) else 1
@@ -93,7 +437,7 @@ def parse_simple_dice(expr: str) -> Optional[dict]:
     mod = int(m.group(3)) if m.group(3) else 0
     if n <= 0 or n > 200 or sides <= 0 or sides > 2000:
         return None
-    rolls = [random.randint(1, sides) for _ in range(n)]
+    rolls = _roll_dice(n, sides)
     total = sum(rolls) + mod
     return {"n": n, "sides": sides, "mod": mod, "rolls": rolls, "total": total}
 
@@ -107,12 +451,12 @@ def roll_expr(expr: str) -> Optional[Tuple[List[int], int]]:
 def roll_d20_with_mod(expr: str) -> Optional[Tuple[int,int]]:
     expr = expr.strip().lower()
     if expr == "":
-        roll = random.randint(1,20); return roll, roll
+        roll = _below20() + 1; return roll, roll
     # if just number like "5" treat as mod only
-    m = re.fullmatch(r'([+-]?\d+)$', expr)
+    m = _MOD_RE.fullmatch(expr)
     if m:
         mod = int(m.group(1))
-        roll = random.randint(1,20)
+        roll = _below20() + 1
         return roll, roll + mod
     # try dice parser
     parsed = parse_simple_dice(expr)
@@ -123,15 +467,73 @@ def roll_d20_with_mod(expr: str) -> Optional[Tuple[int,int]]:
 # ---------------------------
 # HTTP helpers for DnD5e API
 # ---------------------------
+# path -> (fetched_at, response); persisted to API_CACHE_FILE so restarts stay warm.
+# Kept in LRU order (oldest first) and capped at API_CACHE_MAX entries
+_api_cache: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+# path -> fetch in progress; concurrent identical lookups await the same request,
+# and the entry is dropped as soon as it finishes so the map only holds live fetches.
+# Capped at API_CACHE_MAX like the cache itself
+_api_inflight: Dict[str, asyncio.Task] = {}
+
+def load_api_cache():
+    global _api_cache
+    if not os.path.exists(API_CACHE_FILE):
+        return
+    try:
+        raw = _read_json(API_CACHE_FILE)
+        # newest API_CACHE_MAX entries, oldest first
+        entries = sorted(((k, (v[0], v[1])) for k, v in raw.items()), key=lambda kv: kv[1][0])
+        _api_cache = OrderedDict(entries[-API_CACHE_MAX:])
+    except Exception as e:
+        print("Gagal load API cache:", e)
+        _api_cache = OrderedDict()
+
+def save_api_cache():
+    try:
+        # same temp-file-and-rename path as the shards: a kill mid-write keeps the old cache
+        _write_atomic(API_CACHE_FILE, _dumps(_api_cache))
+    except Exception as e:
+        print("Gagal save API cache:", e)
+
+def _api_cache_get(path: str) -> Optional[dict]:
+    hit = _api_cache.get(path)
+    if hit and time.time() - hit[0] < API_CACHE_TTL:
+        _api_cache.move_to_end(path)
+        return hit[1]
+    return None
+
+def _api_cache_put(path: str, data: dict):
+    _api_cache[path] = (time.time(), data)
+    _api_cache.move_to_end(path)
+    if len(_api_cache) > API_CACHE_MAX:
+        _api_cache.popitem(last=False)
+
+load_api_cache()
+
 async def api_get(path: str) -> Optional[dict]:
-    global session
-    if session is None:
-        session = aiohttp.ClientSession()
-    url = f"{API_BASE}/{path.lstrip('/')}"
+    path = path.lstrip('/')
+    cached = _api_cache_get(path)
+    if cached is not None:
+        return cached
+    task = _api_inflight.get(path)
+    if task is None:
+        if len(_api_inflight) >= API_CACHE_MAX:
+            # map full: fetch directly rather than grow it
+            return await _api_fetch(path)
+        task = asyncio.create_task(_api_fetch(path))
+        _api_inflight[path] = task
+        task.add_done_callback(lambda _t: _api_inflight.pop(path, None))
+    # shield: a cancelled caller must not cancel the fetch other callers share
+    return await asyncio.shield(task)
+
+async def _api_fetch(path: str) -> Optional[dict]:
+    url = f"{API_BASE}/{path}"
     try:
         async with session.get(url) as resp:
             if resp.status == 200:
-                return await resp.json()
+                data = await resp.json()
+                _api_cache_put(path, data)
+                return data
             # else return None
             return None
     except Exception as e:
@@ -187,6 +589,9 @@ CLASS_SPELL_SLOTS = {
     "rogue": {}
 }
 
+# API ability score names -> our stat keys
+_ABILITY_MAP = {"Strength":"STR","Dexterity":"DEX","Constitution":"CON","Intelligence":"INT","Wisdom":"WIS","Charisma":"CHA"}
+
 async def get_race_bonuses_from_api(race_name: str) -> dict:
     slug = to_api_slug(race_name)
     data = await api_get(f"races/{slug}")
@@ -195,23 +600,29 @@ async def get_race_bonuses_from_api(race_name: str) -> dict:
     # API returns array of ability bonuses like {"ability_score":{"name":"Dexterity"},"bonus":2}
     bonuses = {}
     for ab in data.get("ability_bonuses", []):
-        name = ab.get("ability_score", {}).get("name", "")
-        if name:
-            key = name[:3].upper()  # "Dexterity" -> "Dex" -> "DEX"
-            # Try mapping: Dexterity -> DEX, Strength -> STR etc.
-            # Safer mapping:
-            mapping = {"Strength":"STR","Dexterity":"DEX","Constitution":"CON","Intelligence":"INT","Wisdom":"WIS","Charisma":"CHA"}
-            full = ab.get("ability_score", {}).get("name")
-            key = mapping.get(full, full[:3].upper())
+        key = _ABILITY_MAP.get(ab.get("ability_score", {}).get("name", ""))
+        if key:
             bonuses[key] = bonuses.get(key, 0) + ab.get("bonus", 0)
     return bonuses
 
+# Skill and spell name lists never change while the bot runs; fetched once and reused
+_SKILLS_CACHE: List[str] = []
+_SPELLS_CACHE: List[str] = []
+_name_lists_lock = asyncio.Lock()
+
+async def load_name_lists():
+    async with _name_lists_lock:
+        if not _SKILLS_CACHE:
+            _SKILLS_CACHE[:] = [s["name"] for s in await api_list("skills")]
+        if not _SPELLS_CACHE:
+            _SPELLS_CACHE[:] = [s["name"] for s in await api_list("spells")]
+
 # pick some random skills from API or fallback to static
 async def pick_skills_for_class(cls: str, count=2) -> List[str]:
     # try querying class endpoint for proficiencies? simplified: use API skills list and pick random
-    skills_list = await api_list("skills")
-    skill_names = [s["name"] for s in skills_list] if skills_list else []
-    if not skill_names:
+    if not _SKILLS_CACHE:
+        await load_name_lists()
+    if not _SKILLS_CACHE:
         # local fallback
         fallback = {
             "wizard":["Arcana","History","Investigation"],
@@ -220,23 +631,27 @@ async def pick_skills_for_class(cls: str, count=2) -> List[str]:
             "cleric":["Religion","Insight","Medicine"]
         }
         return fallback.get(cls.lower(), ["Perception","Athletics"])[:count]
-    return random.sample(skill_names, min(count, len(skill_names)))
+    return _rng.sample(_SKILLS_CACHE, min(count, len(_SKILLS_CACHE)))
 
 # get spells list (names) from API and filter by class
 async def pick_spells_for_class(cls: str, count=3) -> List[str]:
-    spells = await api_list("spells")
-    if not spells:
+    if not _SPELLS_CACHE:
+        await load_name_lists()
+    if not _SPELLS_CACHE:
         return []
     # simple heuristic: pick spells whose description or name includes class (not robust)
-    names = [s["name"] for s in spells]
     # try to prioritize low-level spells for casters
-    # simpler: pick random subset
-    picks = random.sample(names, min(count, len(names)))
-    return picks
-
-async def generate_character(gid: str, name: str, race: str, cls: str) -> dict:
-    gid = str(gid)
-    race_bonuses = await get_race_bonuses_from_api(race)
+    # simpler: pick random subset; sample indices so the shared list is only read, never copied
+    n = len(_SPELLS_CACHE)
+    return [_SPELLS_CACHE[i] for i in _rng.sample(range(n), min(count, n))]
+
+async def generate_character(gid: int, name: str, race: str, cls: str) -> dict:
+    # race, skills and spells lookups are independent; run them concurrently
+    race_bonuses, skills, spells = await asyncio.gather(
+        get_race_bonuses_from_api(race),
+        pick_skills_for_class(cls, count=3),
+        pick_spells_for_class(cls, count=4),
+    )
     # apply base + race + class focus
     stats = BASE_STATS.copy()
     for k,v in race_bonuses.items():
@@ -249,11 +664,9 @@ async def generate_character(gid: str, name: str, race: str, cls: str) -> dict:
     # HP and AC
     hp = cf.get("hd", 8)
     ac = cf.get("ac", 10)
-    # pick skills & spells
-    skills = await pick_skills_for_class(cls, count=3)
-    spells = await pick_spells_for_class(cls, count=4)
     # initialize inventory & slots & level
-    slots = CLASS_SPELL_SLOTS.get(cls.lower(), {}).copy() if CLASS_SPELL_SLOTS.get(cls.lower()) else {}
+    cls_slots = CLASS_SPELL_SLOTS.get(cls.lower())
+    slots = dict(cls_slots) if cls_slots else {}
     char = {
         "name": name,
         "race": race,
@@ -269,9 +682,10 @@ async def generate_character(gid: str, name: str, race: str, cls: str) -> dict:
         "inventory": [],
         "death_saves": {"success":0, "failure":0},
     }
-    characters.setdefault(gid, {})
-    characters[gid][name.lower()] = char
-    save_data()
+    char["_skill_set"] = skill_set_of(char)
+    char["_spell_keys"] = spell_keys_of(char)
+    _put_char(gid, name_key(name), char)
+    mark_dirty(gid)
     return char
 
 # ---------------------------
@@ -298,17 +712,12 @@ def get_damage_expr_from_spell(detail: dict, slot_level: Optional[int]) -> Optio
 # ---------------------------
 # Spell casting management
 # ---------------------------
-async def cast_spell_for_char(gid: str, name: str, spell_name: str, use_slot_level: Optional[int]=None) -> Tuple[str, bool]:
-    gid = str(gid)
-    char = characters.get(gid, {}).get(name.lower())
+async def cast_spell_for_char(gid: int, name: str, spell_name: str, use_slot_level: Optional[int]=None) -> Tuple[str, bool]:
+    char = _get_char(gid, name_key(name))
     if not char:
         return f"Karakter {name} tidak ditemukan.", False
     # check if spell in char spells
-    found = None
-    for s in char.get("spells", []):
-        if s.lower() == spell_name.lower():
-            found = s
-            break
+    found = char["_spell_keys"].get(name_key(spell_name))
     if not found:
         return f"{char['name']} tidak memiliki spell {spell_name}.", False
 
@@ -325,12 +734,13 @@ async def cast_spell_for_char(gid: str, name: str, spell_name: str, use_slot_lev
             return f"{char['name']} tidak punya slot level {level} untuk cast {found}.", False
         # consume slot
         slots[level] = available - 1
-        save_data()
+        invalidate_render(char, "slots")
+        mark_dirty(gid)
 
     # get damage expression
     dmg_expr = get_damage_expr_from_spell(detail, use_slot_level or level)
     # roll attack? For simplicity, we'll show attack roll as d20 (casters may need attack or save)
-    atk_roll = random.randint(1,20)
+    atk_roll = _below20() + 1
     msg = f"✨ {char['name']} melempar spell **{found}** (level {level})\n"
     msg += f"🎲 Attack/Effect roll (d20): **{atk_roll}**\n"
     if dmg_expr:
@@ -373,9 +783,8 @@ LEVEL_UP_HP = {
 def get_con_mod(stat_value: int) -> int:
     return (stat_value - 10) // 2
 
-def level_up_character(gid: str, name: str) -> Tuple[str,bool]:
-    gid = str(gid)
-    char = characters.get(gid, {}).get(name.lower())
+def level_up_character(gid: Optional[int], name: str) -> Tuple[str,bool]:
+    char = _get_char(gid, name_key(name))
     if not char:
         return f"Karakter {name} tidak ditemukan.", False
     cls = char.get("class","").lower()
@@ -384,7 +793,7 @@ def level_up_character(gid: str, name: str) -> Tuple[str,bool]:
     char["level"] = new_level
     # HP gain random roll by class hit die + CON mod
     hd = LEVEL_UP_HP.get(cls, 6)
-    hp_gain = random.randint(1, hd) + get_con_mod(char["stats"].get("CON",10))
+    hp_gain = _randrange(1, hd + 1) + get_con_mod(char["stats"].get("CON",10))
     if hp_gain < 1: hp_gain = 1
     char["max_hp"] = char.get("max_hp", char.get("hp",10)) + hp_gain
     char["hp"] = char["max_hp"]
@@ -392,45 +801,70 @@ def level_up_character(gid: str, name: str) -> Tuple[str,bool]:
     if cls in CLASS_SPELL_SLOTS:
         slots = char.setdefault("slots", {})
         slots[1] = slots.get(1,0) + 1
-    save_data()
+    invalidate_render(char, "slots")
+    mark_dirty(gid)
     return f"⬆️ {char['name']} naik ke level {new_level}! +{hp_gain} HP (Total {char['max_hp']})", True
 
 # ---------------------------
 # Combat tracker and actions (Level 5+)
 # ---------------------------
-def ensure_combat(gid: str):
-    gid = str(gid)
-    if gid not in combats:
-        combats[gid] = {"turn": 0, "order": []}
-        save_data()
+def _new_combat() -> dict:
+    return {"turn": 0, "order": [], "by_name": {}, "next_seq": 0}
+
+def ensure_combat(gid: int) -> dict:
+    c = combats.get(gid)
+    if c is None:
+        c = combats[gid] = _new_combat()
+        mark_dirty(gid)
+    return c
+
+async def _require_combat(ctx, require_order: bool = False) -> Optional[Tuple[int, dict]]:
+    # Resolve (gid, combat) for the calling guild (commands are @require_guild),
+    # or report that no encounter is running
+    gid = ctx.gid
+    c = combats.get(gid)
+    if require_order:
+        if not c or not c["order"]:
+            await ctx.send("Belum ada encounter aktif.")
+            return None
+    elif c is None:
+        await ctx.send("Tidak ada encounter aktif.")
+        return None
+    return gid, c
 
 @bot.command(name="combat_start")
+@require_guild
 async def cmd_combat_start(ctx):
-    gid = get_guild_id(ctx)
-    ensure_combat(gid)
-    combats[str(gid)]["turn"] = 0
-    combats[str(gid)]["order"] = []
-    save_data()
+    gid = ctx.gid
+    combats[gid] = _new_combat()
+    mark_dirty(gid)
     await ctx.send("⚔️ Encounter dimulai. Gunakan `!combat_add <name> <hp> <initiative> [ac]` untuk menambah participant.")
 
 @bot.command(name="combat_add")
+@require_guild
 async def cmd_combat_add(ctx, name: str, hp: int, initiative: int, ac: Optional[int]=None):
-    gid = get_guild_id(ctx)
-    if not gid:
-        return await ctx.send("Perintah hanya di server.")
-    ensure_combat(gid)
-    ent = {"name": name, "hp": int(hp), "initiative": int(initiative), "effects": [], "ac": int(ac) if ac else 10}
-    combats[str(gid)]["order"].append(ent)
-    combats[str(gid)]["order"].sort(key=lambda x: x["initiative"], reverse=True)
-    save_data()
+    gid = ctx.gid
+    c = ensure_combat(gid)
+    ent = {"name": name, "hp": int(hp), "initiative": int(initiative), "effects": [], "ac": int(ac) if ac else 10,
+           "_key": name_key(name), "_seq": c["next_seq"]}
+    c["next_seq"] += 1
+    # order stays sorted, so insert in place instead of re-sorting the whole list
+    bisect.insort(c["order"], ent, key=_initiative_key)
+    # on a shared name the entity first in initiative order wins lookups,
+    # matching a front-to-back scan of "order" (and index_combat after a reload)
+    prev = c["by_name"].get(ent["_key"])
+    if prev is None or _initiative_key(ent) < _initiative_key(prev):
+        c["by_name"][ent["_key"]] = ent
+    mark_dirty(gid)
     await ctx.send(f"➕ {name} ditambahkan ke encounter (HP {hp}, Init {initiative}, AC {ent['ac']}).")
 
 @bot.command(name="combat_status")
+@require_guild
 async def cmd_combat_status(ctx):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats or not combats[str(gid)]["order"]:
-        return await ctx.send("Belum ada encounter aktif.")
-    c = combats[str(gid)]
+    found = await _require_combat(ctx, require_order=True)
+    if not found:
+        return
+    _, c = found
     turn = c["turn"]
     msg_lines = ["📜 **Status Encounter**"]
     for i, e in enumerate(c["order"]):
@@ -440,95 +874,109 @@ async def cmd_combat_status(ctx):
     await ctx.send("\n".join(msg_lines))
 
 @bot.command(name="combat_next")
+@require_guild
 async def cmd_combat_next(ctx):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats or not combats[str(gid)]["order"]:
-        return await ctx.send("Belum ada encounter aktif.")
-    c = combats[str(gid)]
+    found = await _require_combat(ctx, require_order=True)
+    if not found:
+        return
+    gid, c = found
     c["turn"] = (c["turn"] + 1) % len(c["order"])
-    save_data()
+    mark_dirty(gid)
     cur = c["order"][c["turn"]]
     await ctx.send(f"➡️ Sekarang giliran **{cur['name']}** (HP {cur['hp']})")
 
 @bot.command(name="combat_effect")
+@require_guild
 async def cmd_combat_effect(ctx, name: str, *, effect: str):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats:
-        return await ctx.send("Tidak ada encounter aktif.")
-    for ent in combats[str(gid)]["order"]:
-        if ent["name"].lower() == name.lower():
-            ent.setdefault("effects", []).append(effect)
-            save_data()
-            return await ctx.send(f"💫 Efek **{effect}** ditambahkan ke {ent['name']}.")
-    await ctx.send(f"❌ {name} tidak ditemukan di encounter.")
+    found = await _require_combat(ctx)
+    if not found:
+        return
+    gid, c = found
+    ent = c["by_name"].get(name_key(name))
+    if not ent:
+        return await ctx.send(f"❌ {name} tidak ditemukan di encounter.")
+    ent.setdefault("effects", []).append(effect)
+    mark_dirty(gid)
+    await ctx.send(f"💫 Efek **{effect}** ditambahkan ke {ent['name']}.")
 
 @bot.command(name="combat_damage")
+@require_guild
 async def cmd_combat_damage(ctx, name: str, amount: int):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats:
-        return await ctx.send("Tidak ada encounter aktif.")
-    for ent in combats[str(gid)]["order"]:
-        if ent["name"].lower() == name.lower():
-            ent["hp"] -= int(amount)
-            save_data()
-            msg = f"💥 {ent['name']} menerima {amount} damage. HP sekarang: {ent['hp']}"
-            if ent["hp"] <= 0:
-                msg += f"\n☠️ {ent['name']} berada di 0 HP!"
-                # if it's a PC stored in characters, set death state
-                gidstr = str(gid)
-                char = characters.get(gidstr, {}).get(name.lower())
-                if char:
-                    # mark hp at 0 and reset death saves
-                    char["hp"] = 0
-                    char["death_saves"] = {"success":0,"failure":0}
-                    save_data()
-            return await ctx.send(msg)
-    await ctx.send(f"❌ {name} tidak ditemukan di encounter.")
+    found = await _require_combat(ctx)
+    if not found:
+        return
+    gid, c = found
+    key = name_key(name)
+    ent = c["by_name"].get(key)
+    if not ent:
+        return await ctx.send(f"❌ {name} tidak ditemukan di encounter.")
+    ent["hp"] -= int(amount)
+    mark_dirty(gid)
+    msg = f"💥 {ent['name']} menerima {amount} damage. HP sekarang: {ent['hp']}"
+    if ent["hp"] <= 0:
+        msg += f"\n☠️ {ent['name']} berada di 0 HP!"
+        # if it's a PC stored in characters, set death state
+        char = _get_char(gid, key)
+        if char:
+            # mark hp at 0 and reset death saves
+            char["hp"] = 0
+            char["death_saves"] = {"success":0,"failure":0}
+            invalidate_render(char)
+            mark_dirty(gid)
+    await ctx.send(msg)
 
 @bot.command(name="combat_heal")
+@require_guild
 async def cmd_combat_heal(ctx, name: str, amount: int):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats:
-        return await ctx.send("Tidak ada encounter aktif.")
-    for ent in combats[str(gid)]["order"]:
-        if ent["name"].lower() == name.lower():
-            ent["hp"] += int(amount)
-            save_data()
-            return await ctx.send(f"✨ {ent['name']} dipulihkan {amount} HP. HP sekarang: {ent['hp']}")
-    await ctx.send(f"❌ {name} tidak ditemukan di encounter.")
+    found = await _require_combat(ctx)
+    if not found:
+        return
+    gid, c = found
+    ent = c["by_name"].get(name_key(name))
+    if not ent:
+        return await ctx.send(f"❌ {name} tidak ditemukan di encounter.")
+    ent["hp"] += int(amount)
+    mark_dirty(gid)
+    await ctx.send(f"✨ {ent['name']} dipulihkan {amount} HP. HP sekarang: {ent['hp']}")
 
 @bot.command(name="combat_setac")
+@require_guild
 async def cmd_combat_setac(ctx, name: str, ac: int):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats:
-        return await ctx.send("Tidak ada encounter aktif.")
-    for ent in combats[str(gid)]["order"]:
-        if ent["name"].lower() == name.lower():
-            ent["ac"] = int(ac)
-            save_data()
-            return await ctx.send(f"🛡️ AC {ent['name']} di-set ke {ac}.")
-    await ctx.send(f"❌ {name} tidak ditemukan di encounter.")
+    found = await _require_combat(ctx)
+    if not found:
+        return
+    gid, c = found
+    ent = c["by_name"].get(name_key(name))
+    if not ent:
+        return await ctx.send(f"❌ {name} tidak ditemukan di encounter.")
+    ent["ac"] = int(ac)
+    mark_dirty(gid)
+    await ctx.send(f"🛡️ AC {ent['name']} di-set ke {ac}.")
 
 @bot.command(name="combat_end")
+@require_guild
 async def cmd_combat_end(ctx):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats:
-        return await ctx.send("Tidak ada encounter aktif.")
-    combats.pop(str(gid), None)
-    save_data()
+    found = await _require_combat(ctx)
+    if not found:
+        return
+    gid, c = found
+    combats.pop(gid, None)
+    mark_dirty(gid)
     await ctx.send("🏁 Encounter diakhiri.")
 
 # ---------------------------
 # Attack & Saving Throws (Level 6)
 # ---------------------------
 @bot.command(name="attack")
+@require_guild
 async def cmd_attack(ctx, attacker: str, target: str, roll_expr: str):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats:
-        return await ctx.send("Tidak ada encounter aktif.")
-    order = combats[str(gid)]["order"]
-    atk = next((x for x in order if x["name"].lower() == attacker.lower()), None)
-    tgt = next((x for x in order if x["name"].lower() == target.lower()), None)
+    found = await _require_combat(ctx)
+    if not found:
+        return
+    _, c = found
+    by_name = c["by_name"]
+    atk = by_name.get(name_key(attacker))
+    tgt = by_name.get(name_key(target))
     if not atk or not tgt:
         return await ctx.send("Attacker atau target tidak ditemukan dalam encounter.")
     parsed = parse_simple_dice(roll_expr)
@@ -549,11 +997,14 @@ async def cmd_attack(ctx, attacker: str, target: str, roll_expr: str):
     await ctx.send(msg)
 
 @bot.command(name="save")
+@require_guild
 async def cmd_save(ctx, name: str, ability: str, dc: int):
-    gid = get_guild_id(ctx)
-    if not gid or str(gid) not in combats:
-        return await ctx.send("Tidak ada encounter aktif.")
-    ent = next((x for x in combats[str(gid)]["order"] if x["name"].lower() == name.lower()), None)
+    found = await _require_combat(ctx)
+    if not found:
+        return
+    gid, c = found
+    key = name_key(name)
+    ent = c["by_name"].get(key)
     if not ent:
         return await ctx.send(f"{name} tidak ditemukan.")
     ability = ability.lower()
@@ -561,12 +1012,12 @@ async def cmd_save(ctx, name: str, ability: str, dc: int):
     if ability not in mapping:
         return await ctx.send("Ability tidak valid (gunakan str/dex/con/int/wis/cha).")
     # find if entity is a PC with stats
-    char = characters.get(str(gid), {}).get(name.lower())
+    char = _get_char(gid, key)
     mod = 0
     if char:
         val = char["stats"].get(mapping[ability], 10)
         mod = (val - 10) // 2
-    roll = random.randint(1,20) + mod
+    roll = _below20() + 1 + mod
     success = roll >= dc
     await ctx.send(f"🛡️ **{name}** melakukan saving throw {mapping[ability]} (DC {dc}): d20 + mod = **{roll}** → {'✅ Success' if success else '❌ Failed'}")
 
@@ -574,20 +1025,22 @@ async def cmd_save(ctx, name: str, ability: str, dc: int):
 # Death saves (Level 7)
 # ---------------------------
 @bot.command(name="deathsave")
+@require_guild
 async def cmd_deathsave(ctx, name: str):
-    gid = get_guild_id(ctx)
-    gidstr = str(gid)
-    char = characters.get(gidstr, {}).get(name.lower())
+    gid = ctx.gid
+    key = name_key(name)
+    char = _get_char(gid, key)
     if not char:
         return await ctx.send(f"Karakter {name} tidak ditemukan.")
     if char.get("hp",1) > 0:
         return await ctx.send(f"{char['name']} tidak berada di 0 HP.")
-    roll = random.randint(1,20)
+    roll = _below20() + 1
     if roll == 20:
         # regain 1 HP and stabilize
         char["hp"] = 1
         char["death_saves"] = {"success":0,"failure":0}
-        save_data()
+        invalidate_render(char)
+        mark_dirty(gid)
         return await ctx.send(f"🎉 Natural 20! {char['name']} bangkit dengan 1 HP.")
     elif roll == 1:
         char["death_saves"]["failure"] += 2
@@ -595,18 +1048,18 @@ async def cmd_deathsave(ctx, name: str):
         char["death_saves"]["success"] += 1
     else:
         char["death_saves"]["failure"] += 1
-    save_data()
+    mark_dirty(gid)
     ds = char["death_saves"]
     if ds["success"] >= 3:
         # stabilized but still at 0 HP; treat as stable but unconscious
         char["death_saves"] = {"success":0,"failure":0}
-        save_data()
+        mark_dirty(gid)
         return await ctx.send(f"✅ {char['name']} berhasil stabil (3 success).")
     if ds["failure"] >= 3:
         # character dies
         # remove or mark dead
-        del characters[gidstr][name.lower()]
-        save_data()
+        _del_char(gid, key)
+        mark_dirty(gid)
         return await ctx.send(f"☠️ {name} gagal death saves 3x — meninggal.")
     await ctx.send(f"🎲 Death Save roll: {roll} → Successes: {ds['success']} | Failures: {ds['failure']}")
 
@@ -638,21 +1091,22 @@ async def cmd_monster(ctx, *, monster_name: str):
 # Inventory commands & API item
 # ---------------------------
 @bot.command(name="inventory_add")
+@require_guild
 async def cmd_inv_add(ctx, name: str, *, item: str):
-    gid = get_guild_id(ctx)
-    gidstr = str(gid)
-    char = characters.get(gidstr, {}).get(name.lower())
+    gid = ctx.gid
+    char = _get_char(gid, name_key(name))
     if not char:
         return await ctx.send(f"Karakter {name} tidak ditemukan.")
     char.setdefault("inventory", []).append({"name": item})
-    save_data()
+    invalidate_render(char, "inventory")
+    mark_dirty(gid)
     await ctx.send(f"👜 {item} ditambahkan ke inventori {char['name']}.")
 
 @bot.command(name="inventory_add_api")
+@require_guild
 async def cmd_inv_add_api(ctx, name: str, *, item_name: str):
-    gid = get_guild_id(ctx)
-    gidstr = str(gid)
-    char = characters.get(gidstr, {}).get(name.lower())
+    gid = ctx.gid
+    char = _get_char(gid, name_key(name))
     if not char:
         return await ctx.send(f"Karakter {name} tidak ditemukan.")
     detail = await fetch_item_detail(item_name)
@@ -660,83 +1114,108 @@ async def cmd_inv_add_api(ctx, name: str, *, item_name: str):
         return await ctx.send(f"❌ Item '{item_name}' tidak ditemukan di API.")
     item_obj = {"name": detail.get("name","Unknown"), "desc": detail.get("desc",[])}
     char.setdefault("inventory", []).append(item_obj)
-    save_data()
+    invalidate_render(char, "inventory")
+    mark_dirty(gid)
     await ctx.send(f"👜 {item_obj['name']} ditambahkan ke inventori {char['name']} (dari API).")
 
 @bot.command(name="inventory_list")
+@require_guild
 async def cmd_inv_list(ctx, name: str):
-    gid = get_guild_id(ctx)
-    gidstr = str(gid)
-    char = characters.get(gidstr, {}).get(name.lower())
+    gid = ctx.gid
+    char = _get_char(gid, name_key(name))
     if not char:
         return await ctx.send(f"Karakter {name} tidak ditemukan.")
     inv = char.get("inventory", [])
     if not inv:
         return await ctx.send(f"📦 Inventori {char['name']} kosong.")
-    out = "\n".join([f"- {i.get('name')}" if isinstance(i, dict) else f"- {i}" for i in inv])
+    out = "\n".join([f"- {i['name']}" for i in inv])
     await ctx.send(f"👜 Inventori {char['name']}:\n{out}")
 
 @bot.command(name="inventory_remove")
+@require_guild
 async def cmd_inv_remove(ctx, name: str, *, item: str):
-    gid = get_guild_id(ctx)
-    gidstr = str(gid)
-    char = characters.get(gidstr, {}).get(name.lower())
+    gid = ctx.gid
+    char = _get_char(gid, name_key(name))
     if not char:
         return await ctx.send(f"Karakter {name} tidak ditemukan.")
     inv = char.get("inventory", [])
     found_index = None
+    item_l = item.lower()
     for i,entry in enumerate(inv):
-        if (isinstance(entry,dict) and entry.get("name","").lower() == item.lower()) or (isinstance(entry,str) and entry.lower()==item.lower()):
+        if entry["name"].lower() == item_l:
             found_index = i; break
     if found_index is None:
         return await ctx.send(f"{char['name']} tidak memiliki item {item}.")
     removed = inv.pop(found_index)
-    save_data()
-    await ctx.send(f"🗑️ {removed.get('name',removed)} dihapus dari inventori {char['name']}.")
+    invalidate_render(char, "inventory")
+    mark_dirty(gid)
+    await ctx.send(f"🗑️ {removed['name']} dihapus dari inventori {char['name']}.")
 
 # ---------------------------
 # Character create, status, sheet embed
 # ---------------------------
+# Sheet fields that only change through specific mutators; rendered text is cached
+# in char["_rendered"] and dropped via invalidate_render() by whoever mutates it
+_FIELD_RENDERERS = {
+    "stats": lambda c: "\n".join([f"**{k}**: {v}" for k,v in c.get("stats",{}).items()]),
+    "skills": lambda c: ", ".join(c.get("skills",[])) or "None",
+    "spells": lambda c: ", ".join(c.get("spells",[])) or "None",
+    "slots": lambda c: "\n".join([f"Level {k}: {v}" for k,v in c.get("slots",{}).items()]),
+    "inventory": lambda c: ", ".join([i["name"] for i in c.get("inventory",[])]),
+}
+
+def rendered_field(char: dict, key: str) -> str:
+    cache = char.setdefault("_rendered", {})
+    text = cache.get(key)
+    if text is None:
+        text = cache[key] = _FIELD_RENDERERS[key](char)
+    return text
+
+def invalidate_render(char: dict, *keys: str):
+    # the whole-sheet embed covers every field (HP, level too), so it always goes
+    char.pop("_embed_dict", None)
+    cache = char.get("_rendered")
+    if cache:
+        for k in keys:
+            cache.pop(k, None)
+
 def build_character_embed(char: dict) -> discord.Embed:
+    cached = char.get("_embed_dict")
+    if cached is not None:
+        return discord.Embed.from_dict(cached)
     embed = discord.Embed(title=f"{char['name']} — {char.get('race','')} {char.get('class','')}", color=discord.Color.blue())
     embed.add_field(name="Level", value=str(char.get("level",1)), inline=True)
     embed.add_field(name="HP", value=f"{char.get('hp')}/{char.get('max_hp',char.get('hp'))}", inline=True)
     embed.add_field(name="AC", value=str(char.get("ac",10)), inline=True)
-    # stats
-    stats_text = "\n".join([f"**{k}**: {v}" for k,v in char.get("stats",{}).items()])
-    embed.add_field(name="Stats", value=stats_text, inline=False)
-    # skills
-    embed.add_field(name="Skills", value=", ".join(char.get("skills",[])) or "None", inline=False)
-    # spells
-    embed.add_field(name="Spells", value=", ".join(char.get("spells",[])) or "None", inline=False)
-    # slots
-    slots = char.get("slots",{})
-    if slots:
-        embed.add_field(name="Spell Slots", value="\n".join([f"Level {k}: {v}" for k,v in slots.items()]), inline=False)
-    # inventory
-    inv = char.get("inventory",[])
-    if inv:
-        inv_text = ", ".join([i.get("name") if isinstance(i,dict) else str(i) for i in inv])
+    embed.add_field(name="Stats", value=rendered_field(char, "stats"), inline=False)
+    embed.add_field(name="Skills", value=rendered_field(char, "skills"), inline=False)
+    embed.add_field(name="Spells", value=rendered_field(char, "spells"), inline=False)
+    # slots / inventory render to "" when empty and are left off the sheet
+    slots_text = rendered_field(char, "slots")
+    if slots_text:
+        embed.add_field(name="Spell Slots", value=slots_text, inline=False)
+    inv_text = rendered_field(char, "inventory")
+    if inv_text:
         embed.add_field(name="Inventory", value=inv_text, inline=False)
+    char["_embed_dict"] = embed.to_dict()
     return embed
 
 @bot.command(name="char_create")
+@require_guild
 async def cmd_char_create(ctx, name: str, race: str, cls: str):
-    gid = get_guild_id(ctx)
-    if not gid:
-        return await ctx.send("Command hanya boleh dipakai di server.")
+    gid = ctx.gid
     char = await generate_character(gid, name, race, cls)
     # ensure max_hp present
     char.setdefault("max_hp", char.get("hp",10))
-    save_data()
+    mark_dirty(gid)
     embed = build_character_embed(char)
     await ctx.send("🧙 Karakter dibuat:", embed=embed)
 
 @bot.command(name="char_status")
+@require_guild
 async def cmd_char_status(ctx, name: str):
-    gid = get_guild_id(ctx)
-    gidstr = str(gid)
-    char = characters.get(gidstr, {}).get(name.lower())
+    gid = ctx.gid
+    char = _get_char(gid, name_key(name))
     if not char:
         return await ctx.send(f"Karakter {name} tidak ditemukan.")
     embed = build_character_embed(char)
@@ -746,9 +1225,10 @@ async def cmd_char_status(ctx, name: str):
 # Spell commands
 # ---------------------------
 @bot.command(name="slots")
+@require_guild
 async def cmd_slots(ctx, name: str):
-    gid = get_guild_id(ctx)
-    char = characters.get(str(gid), {}).get(name.lower())
+    gid = ctx.gid
+    char = _get_char(gid, name_key(name))
     if not char:
         return await ctx.send("Karakter tidak ditemukan.")
     slots = char.get("slots",{})
@@ -758,127 +1238,178 @@ async def cmd_slots(ctx, name: str):
     await ctx.send(f"🔮 Slot untuk {char['name']}:\n{txt}")
 
 @bot.command(name="longrest")
+@require_guild
 async def cmd_longrest(ctx, name: str):
-    gid = get_guild_id(ctx)
-    char = characters.get(str(gid), {}).get(name.lower())
+    gid = ctx.gid
+    char = _get_char(gid, name_key(name))
     if not char:
         return await ctx.send("Karakter tidak ditemukan.")
     # reset slots to class defaults
     cls = char.get("class","").lower()
     char["slots"] = CLASS_SPELL_SLOTS.get(cls, {}).copy()
+    invalidate_render(char, "slots")
     char["hp"] = char.get("max_hp", char.get("hp",10))
-    save_data()
+    mark_dirty(gid)
     await ctx.send(f"😴 {char['name']} melakukan long rest: HP dan slot dipulihkan.")
 
 @bot.command(name="cast")
+@require_guild
 async def cmd_cast(ctx, name: str, *, spell: str):
-    gid = get_guild_id(ctx)
-    if not gid:
-        return await ctx.send("Perintah hanya di server.")
+    gid = ctx.gid
     msg, ok = await cast_spell_for_char(gid, name, spell)
     await ctx.send(msg)
 
 # ---------------------------
 # NPC / Quest generator (simple)
 # ---------------------------
-NPC_NAMES = ["Elandra","Borric","Mira","Galen","Thorin","Lysa","Keth","Asha","Roran","Isolde"]
-NPC_ROLES = ["blacksmith","innkeeper","merchant","wizard","priest","ranger","thief","noble"]
-QUEST_HOOKS = [
+NPC_NAMES = ("Elandra","Borric","Mira","Galen","Thorin","Lysa","Keth","Asha","Roran","Isolde")
+NPC_ROLES = ("blacksmith","innkeeper","merchant","wizard","priest","ranger","thief","noble")
+QUEST_HOOKS = (
     "Sebuah desa dikepung makhluk malam.",
     "Sebuah artefak kuno hilang dari kuil.",
     "Seorang bangsawan meminta bantuan untuk menemukan adiknya.",
     "Kawanan goblin mencuri ternak.",
     "Reruntuhan di pegunungan memancarkan cahaya aneh."
-]
+)
+# fixed detail pools, built once; interned so every pick hands back the same str object
+_PERSONALITIES = tuple(map(sys.intern, ("friendly","grumpy","mysterious","talkative","secretive")))
+_SECRETS = tuple(map(sys.intern, ("works for thieves' guild","hides a magical scar","is actually a refugee","is cursed")))
+_TWISTS = tuple(map(sys.intern, ("pihak yang disangka musuh sebenarnya korban","penjaga kuil adalah ras kuno","ada jebakan waktu di situs")))
+_LOCATIONS = tuple(map(sys.intern, ("hutan terlarang","desa nelayan","reruntuhan gua","kuil terpencil")))
+
+_NPC_POOLS = (NPC_NAMES, NPC_ROLES, _PERSONALITIES, _SECRETS)
+
+def _pool_space(pools) -> int:
+    space = 1
+    for pool in pools:
+        space *= len(pool)
+    return space
+
+_npc_draw = _make_below(_pool_space(_NPC_POOLS))
+
+# A quest message depends only on its three picks, so every combination is rendered
+# once here and !quest just indexes one (60 short strings)
+_QUEST_MESSAGES = tuple(
+    f"🗺️ Quest Hook: {hook}\nLocation: {location}\nTwist: {twist}"
+    for hook in QUEST_HOOKS for twist in _TWISTS for location in _LOCATIONS
+)
+_pick_quest = _make_choice(_QUEST_MESSAGES)
+
+def _pick_each(pools, draw) -> List[str]:
+    # One uniform draw over every combination, decoded one pool at a time (mixed radix),
+    # instead of a separate RNG call per pool
+    r = draw()
+    picks = []
+    for pool in pools:
+        r, i = divmod(r, len(pool))
+        picks.append(pool[i])
+    return picks
 
 @bot.command(name="npc")
 async def cmd_npc(ctx, *, role: Optional[str]=None):
-    name = random.choice(NPC_NAMES)
-    role_choice = role or random.choice(NPC_ROLES)
-    personality = random.choice(["friendly","grumpy","mysterious","talkative","secretive"])
-    secret = random.choice(["works for thieves' guild","hides a magical scar","is actually a refugee","is cursed"])
+    name, role_pick, personality, secret = _pick_each(_NPC_POOLS, _npc_draw)
+    role_choice = role or role_pick
     await ctx.send(f"🎭 NPC: **{name}** — {role_choice}\nPersonality: {personality}\nSecret: {secret}")
 
 @bot.command(name="quest")
 async def cmd_quest(ctx):
-    hook = random.choice(QUEST_HOOKS)
-    twist = random.choice(["pihak yang disangka musuh sebenarnya korban","penjaga kuil adalah ras kuno","ada jebakan waktu di situs"])
-    location = random.choice(["hutan terlarang","desa nelayan","reruntuhan gua","kuil terpencil"])
-    await ctx.send(f"🗺️ Quest Hook: {hook}\nLocation: {location}\nTwist: {twist}")
+    await ctx.send(_pick_quest())
 
 # ---------------------------
 # Skill check
 # ---------------------------
 @bot.command(name="skill")
+@require_guild
 async def cmd_skill(ctx, name: str, *, skill: str):
-    gid = get_guild_id(ctx)
-    char = characters.get(str(gid), {}).get(name.lower())
+    gid = ctx.gid
+    char = _get_char(gid, name_key(name))
     if not char:
         return await ctx.send("Karakter tidak ditemukan.")
+    skill_t = skill.title()
     # if skill in list -> give proficiency bonus (simple +2)
-    bonus = 2 if skill.title() in char.get("skills",[]) else 0
-    roll = random.randint(1,20)
+    bonus = 2 if name_key(skill) in (char.get("_skill_set") or _EMPTY_FS) else 0
+    roll = _below20() + 1
     total = roll + bonus
-    await ctx.send(f"🎲 {char['name']} melakukan check **{skill.title()}** → d20({roll}) + bonus({bonus}) = **{total}**")
+    await ctx.send(f"🎲 {char['name']} melakukan check **{skill_t}** → d20({roll}) + bonus({bonus}) = **{total}**")
 
 # ---------------------------
 # Level up command
 # ---------------------------
 @bot.command(name="levelup")
+@require_guild
 async def cmd_levelup(ctx, name: str):
-    gid = get_guild_id(ctx)
+    gid = ctx.gid
     msg, ok = level_up_character(gid, name)
     await ctx.send(msg)
 
 # ---------------------------
 # Misc: help
 # ---------------------------
-@bot.command(name="help")
-async def cmd_help(ctx):
-    h = (
-        "**Perintah Utama**\n"
-        "`!help` - tampilkan pesan ini\n"
-        "`!roll <XdY+Z>` - lempar dadu\n"
+# Built once at import; the same embed is sent on every !help
+_HELP_EMBED = discord.Embed(title="Perintah Utama", description="`!help` - tampilkan pesan ini", color=discord.Color.blue())
+_HELP_EMBED.add_field(name="Dadu", value="`!roll <XdY+Z>` - lempar dadu", inline=False)
+_HELP_EMBED.add_field(
+    name="Karakter",
+    value=(
         "`!char_create <name> <race> <class>` - auto-generate character\n"
         "`!char_status <name>` / `!sheet <name>` - tampilkan sheet\n"
         "`!levelup <name>` - naik level\n"
-        "`!inventory_add <name> <item>` / `!inventory_add_api <name> <item>` / `!inventory_list <name>` / `!inventory_remove <name> <item>`\n"
-        "`!cast <name> <spell>` / `!slots <name>` / `!longrest <name>`\n"
-        "`!combat_start` / `!combat_add <name> <hp> <init> [ac]` / `!combat_status` / `!combat_next` / `!combat_damage` / `!combat_heal` / `!combat_setac` / `!combat_end`\n"
-        "`!attack <attacker> <target> <d20+mod>` / `!save <name> <ability> <DC>` / `!deathsave <name>`\n"
-        "`!monster <name>` / `!npc` / `!quest` / `!skill <name> <skill>`\n"
-    )
-    await ctx.send(h)
+        "`!skill <name> <skill>`"
+    ),
+    inline=False,
+)
+_HELP_EMBED.add_field(
+    name="Inventory",
+    value="`!inventory_add <name> <item>` / `!inventory_add_api <name> <item>` / `!inventory_list <name>` / `!inventory_remove <name> <item>`",
+    inline=False,
+)
+_HELP_EMBED.add_field(name="Spell", value="`!cast <name> <spell>` / `!slots <name>` / `!longrest <name>`", inline=False)
+_HELP_EMBED.add_field(
+    name="Combat",
+    value=(
+        "`!combat_start` / `!combat_add <name> <hp> <init> [ac]` / `!combat_status` / `!combat_next` / "
+        "`!combat_damage` / `!combat_heal` / `!combat_setac` / `!combat_end`\n"
+        "`!attack <attacker> <target> <d20+mod>` / `!save <name> <ability> <DC>` / `!deathsave <name>`"
+    ),
+    inline=False,
+)
+_HELP_EMBED.add_field(name="Lainnya", value="`!monster <name>` / `!npc` / `!quest`", inline=False)
+
+@bot.command(name="help")
+async def cmd_help(ctx):
+    await ctx.send(embed=_HELP_EMBED)
 
 # ---------------------------
 # Startup / Shutdown
 # ---------------------------
 @bot.event
 async def on_ready():
-    global session
-    if session is None:
-        session = aiohttp.ClientSession()
+    global _flush_task
+    # on_ready fires again after reconnects; keep a single flusher running
+    if _flush_task is None or _flush_task.done():
+        _flush_task = _spawn(_flusher())
+    # warm the skill/spell name lists so the first !char_create skips those requests
+    await load_name_lists()
     print(f"Bot siap sebagai {bot.user} (ID: {bot.user.id})")
-    # ensure data saved on start
-    save_data()
-
-@bot.event
-async def on_disconnect():
-    # close session
-    global session
-    if session:
-        asyncio.create_task(session.close())
-        session = None
 
 # Graceful shutdown helper (optional)
 async def shutdown():
-    global session
-    save_data()
-    if session:
-        await session.close()
+    # same path as the background flusher: encode on the loop, write in a worker thread
+    await _flush()
+    await asyncio.to_thread(save_api_cache)
+    # DMBot.close() also closes the shared HTTP session
+    await bot.close()
 
 # Run
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    # libuv-based loop; bot.run() picks up the policy. uvloop has no Windows build,
+    # so there the default loop stays
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     try:
         bot.run(TOKEN)
     finally: